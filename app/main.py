@@ -1,19 +1,61 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import hashlib
 import importlib
+import os
 import shutil
+import zipfile
 import tempfile
+import threading
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Any, Literal
 
+import aiofiles
+import cachetools
 import markdown as mdlib
+import orjson
+import pymupdf
+import zstandard
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from starlette.background import BackgroundTask
 
+try:
+    from markdown_it_pyrs import MarkdownIt
+
+    # Built once at import; "gfm" covers tables, strikethrough and
+    # autolinks natively, fenced code is part of CommonMark. ValueError is
+    # caught too so an unknown config degrades to the fallback renderer
+    # instead of killing startup.
+    _md_renderer: MarkdownIt | None = MarkdownIt("gfm")
+except (ImportError, ValueError):
+    _md_renderer = None
+
+# The imported pymupdf4llm module and whether pymupdf-layout has been
+# activated. Activation is global and irreversible in-process — the reload
+# re-executes the package in place, so there is no separate "plain" module
+# afterwards. That is why layout conversions run in their own worker pool
+# below: plain-pool workers must never be contaminated, or their output
+# would be cached under non-layout cache keys.
+_pymupdf4llm_module: Any = None
+_layout_activated = False
+_pymupdf4llm_import_lock = threading.Lock()
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # Pay the pymupdf4llm import (hundreds of ms) once at startup instead
+    # of on the first request.
+    _get_pymupdf4llm(use_layout=False)
+    yield
+
+
 app = FastAPI(
+    lifespan=_lifespan,
     title="PyMuPDF4LLM API",
     version="1.0.0",
     description=(
@@ -30,6 +72,74 @@ app = FastAPI(
 )
 
 
+_PRECOMPRESSED_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".zst"}
+
+# Markdown rendering is pure CPU; a process pool keeps it off the event loop
+# and spreads pages across cores. Workers amortize the extension setup.
+_html_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+_CACHE_DIR = Path(os.environ.get("PYMUPDF4LLM_CACHE_DIR", "/tmp/pymupdf4llm-cache"))
+_cache: cachetools.LRUCache = cachetools.LRUCache(maxsize=128)
+_cache_lock = threading.Lock()
+
+
+def _cache_key(pdf_digest: str, kwargs: dict[str, Any]) -> str:
+    return (
+        pdf_digest
+        + "|"
+        + orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS, default=str).decode("utf-8")
+    )
+
+
+def _cache_file(key: str) -> Path:
+    name = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+    return _CACHE_DIR / f"{name}.json.zst"
+
+
+def _cache_get(key: str) -> dict[str, Any] | None:
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None:
+        return cached
+    cache_file = _cache_file(key)
+    try:
+        payload = orjson.loads(zstandard.decompress(cache_file.read_bytes()))
+    except (OSError, ValueError, zstandard.ZstdError):
+        return None
+    with _cache_lock:
+        _cache[key] = payload
+    return payload
+
+
+def _cache_put(key: str, payload: dict[str, Any]) -> None:
+    with _cache_lock:
+        _cache[key] = payload
+    cache_file = _cache_file(key)
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_file.write_bytes(zstandard.compress(orjson.dumps(payload)))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # The disk tier is best-effort; the in-memory entry is already set.
+        pass
+
+
+def _write_bytes(path: Path, data: bytes) -> None:
+    # Single copy to the page cache: raw os.write on pre-encoded bytes,
+    # skipping TextIOWrapper buffering and the per-call encode that
+    # Path.write_text performs. os.write may write less than asked
+    # (signals, ENOSPC retries, the kernel's per-write cap), so loop over
+    # a memoryview until every byte has landed.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
 def _cleanup_path(path: Path) -> None:
     if path.is_file():
         path.unlink(missing_ok=True)
@@ -37,21 +147,36 @@ def _cleanup_path(path: Path) -> None:
         shutil.rmtree(path, ignore_errors=True)
 
 
+_MD_EXTENSIONS = ["extra", "tables", "fenced_code", "sane_lists", "toc"]
+_md_local = threading.local()
+
+
+def _fallback_markdown() -> mdlib.Markdown:
+    # One configured instance per thread: extension loading dominates
+    # small-page renders, and Markdown objects are not thread-safe.
+    md = getattr(_md_local, "md", None)
+    if md is None:
+        md = mdlib.Markdown(extensions=_MD_EXTENSIONS, output_format="html")
+        _md_local.md = md
+    return md
+
+
 def _markdown_to_html(markdown_text: str) -> str:
-    return mdlib.markdown(
-        markdown_text,
-        extensions=["extra", "tables", "fenced_code", "sane_lists", "toc"],
-    )
+    if _md_renderer is not None:
+        return _md_renderer.render(markdown_text)
+    md = _fallback_markdown()
+    md.reset()
+    return md.convert(markdown_text)
 
 
 def _normalize_page_chunks(page_chunks: Any) -> list[dict[str, Any]]:
     if not isinstance(page_chunks, list):
         return []
-    normalized: list[dict[str, Any]] = []
-    for chunk in page_chunks:
-        if isinstance(chunk, dict):
-            normalized.append(chunk)
-    return normalized
+    # pymupdf4llm returns a list of dicts in the steady case; return it
+    # as-is and only pay for a rebuild when stray entries need filtering.
+    if all(isinstance(chunk, dict) for chunk in page_chunks):
+        return page_chunks
+    return [chunk for chunk in page_chunks if isinstance(chunk, dict)]
 
 
 def _activate_layout_if_requested(use_layout: bool) -> bool:
@@ -73,22 +198,65 @@ def _activate_layout_if_requested(use_layout: bool) -> bool:
 
 
 def _get_pymupdf4llm(use_layout: bool):
-    _activate_layout_if_requested(use_layout)
-    module = importlib.import_module("pymupdf4llm")
-    if use_layout:
-        module = importlib.reload(module)
-    return module
-
-
-def _safe_to_markdown(lib: Any, doc_path: str, **kwargs: Any):
+    global _pymupdf4llm_module, _layout_activated
+    with _pymupdf4llm_import_lock:
+        if _pymupdf4llm_module is None:
+            _pymupdf4llm_module = importlib.import_module("pymupdf4llm")
+        if use_layout and not _layout_activated:
+            _activate_layout_if_requested(use_layout)
+            # Reload once so pymupdf4llm picks up the activated layout
+            # engine; from here on this process is layout-only.
+            _pymupdf4llm_module = importlib.reload(_pymupdf4llm_module)
+            _layout_activated = True
+        return _pymupdf4llm_module
+
+
+def _safe_to_markdown(lib: Any, doc: Any, **kwargs: Any):
     try:
-        return lib.to_markdown(doc_path, **kwargs)
+        return lib.to_markdown(doc, **kwargs)
     except Exception as exc:
         if "min() iterable argument is empty" not in str(exc):
             raise
         retry_kwargs = dict(kwargs)
         retry_kwargs["hdr_info"] = False
-        return lib.to_markdown(doc_path, **retry_kwargs)
+        return lib.to_markdown(doc, **retry_kwargs)
+
+
+def _init_convert_worker() -> None:
+    # Pay the pymupdf4llm import once per worker process, not per task.
+    importlib.import_module("pymupdf4llm")
+
+
+def _convert_pdf(pdf_path: str, use_layout: bool, kwargs: dict[str, Any]) -> list[dict[str, Any]]:
+    lib = _get_pymupdf4llm(use_layout)
+    try:
+        with pymupdf.open(pdf_path) as doc:
+            chunks_raw = _safe_to_markdown(lib, doc, page_chunks=True, **kwargs)
+    finally:
+        # Each worker owns a private MuPDF store; drop it with the task so
+        # image-heavy PDFs cannot ratchet worker RSS upward.
+        pymupdf.TOOLS.store_shrink(100)
+    # Round-trip to plain JSON types so the result pickles cheaply and
+    # matches what the cache tier stores.
+    return orjson.loads(orjson.dumps(_normalize_page_chunks(chunks_raw), default=str))
+
+
+# Conversions get their own pool (the HTML pool shares the cores): each
+# task runs with true parallelism instead of fighting for the GIL during
+# pymupdf4llm's pure-Python layout work.
+_convert_pool = ProcessPoolExecutor(
+    max_workers=max(1, (os.cpu_count() or 2) // 2),
+    initializer=_init_convert_worker,
+)
+
+# Layout conversions permanently switch their worker to layout mode (see
+# _get_pymupdf4llm), so they are segregated here to keep plain-pool
+# workers — and therefore the cache — uncontaminated. Workers only spawn
+# if a use_layout request ever arrives.
+_layout_convert_pool = ProcessPoolExecutor(
+    max_workers=max(1, (os.cpu_count() or 2) // 2),
+    initializer=_init_convert_worker,
+)
 
 
 @app.get(
@@ -113,7 +281,12 @@ def health() -> dict[str, str]:
     ),
     responses={
         200: {
-            "description": "Successful processing. Returns application/zip or application/json.",
+            "description": (
+                "Successful processing. Returns application/zip or application/json. "
+                "Example shows the default include_html=false shape; with "
+                "include_html=true the html fields carry rendered HTML and the "
+                "manifest files gain full_html / pages_html_dir entries."
+            ),
             "content": {
                 "application/json": {
                     "example": {
@@ -128,20 +301,18 @@ def health() -> dict[str, str]:
                             "images": ["input.pdf-0-0.png"],
                             "files": {
                                 "full_markdown": "full.md",
-                                "full_html": "full.html",
                                 "pages_dir": "pages/",
-                                "pages_html_dir": "pages_html/",
                                 "images_dir": "images/",
                             },
                         },
                         "full_markdown": "# Title\\n...",
-                        "full_html": "<h1 id=\"title\">Title</h1>",
+                        "full_html": None,
                         "layout_active": False,
                         "pages": [
                             {
                                 "page_number": 1,
                                 "markdown": "# Page 1\\n...",
-                                "html": "<h1 id=\"page-1\">Page 1</h1>",
+                                "html": None,
                                 "metadata": {},
                             }
                         ],
@@ -178,7 +349,18 @@ async def process_pdf(
         False,
         description="Enable optional pymupdf-layout mode (requires layout-enabled image).",
     ),
-) -> JSONResponse | FileResponse:
+    include_html: bool = Form(
+        False,
+        description=(
+            "Render HTML outputs (full.html, pages_html/ artifacts and JSON html fields). "
+            "HTML rendering is skipped entirely when false."
+        ),
+    ),
+    force_refresh: bool = Form(
+        False,
+        description="Bypass the parse cache and re-run PyMuPDF4LLM from scratch.",
+    ),
+) -> ORJSONResponse | FileResponse:
     if not file.filename or not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF uploads are supported.")
 
@@ -202,8 +384,13 @@ async def process_pdf(
     images_dir.mkdir(parents=True, exist_ok=True)
 
     try:
-        input_pdf.write_bytes(await file.read())
-        pymupdf4llm = _get_pymupdf4llm(use_layout)
+        # Stream the upload to disk in 1 MiB chunks instead of materializing
+        # the whole PDF in RAM; hash incrementally so no second pass is needed.
+        hasher = hashlib.blake2b(digest_size=16)
+        async with aiofiles.open(input_pdf, "wb") as out:
+            while chunk := await file.read(1 << 20):
+                hasher.update(chunk)
+                await out.write(chunk)
         layout_active = use_layout
 
         markdown_kwargs = {
@@ -214,30 +401,94 @@ async def process_pdf(
             "image_path": str(images_dir),
         }
 
-        full_markdown = _safe_to_markdown(pymupdf4llm, str(input_pdf), **markdown_kwargs)
-        chunks_raw = _safe_to_markdown(
-            pymupdf4llm,
-            str(input_pdf),
-            page_chunks=True,
-            dpi=dpi,
-            force_text=force_text,
-            write_images=False,
-            embed_images=False,
+        # Image files are a side effect of the parse, so runs that write them
+        # cannot be served from cache.
+        cacheable = not write_images
+        pdf_digest = hasher.hexdigest()
+        cache_key = _cache_key(
+            pdf_digest,
+            {
+                "dpi": dpi,
+                "force_text": force_text,
+                "embed_images": embed_images,
+                "use_layout": use_layout,
+            },
+        )
+
+        cached = (
+            None
+            if (force_refresh or not cacheable)
+            else await asyncio.to_thread(_cache_get, cache_key)
         )
+        loop = asyncio.get_running_loop()
+        if cached is not None:
+            page_chunks = _normalize_page_chunks(cached.get("page_chunks"))
+            full_markdown = str(cached.get("full_markdown", ""))
+        else:
+            # Fail fast here with a clean 400 if layout support is missing;
+            # the worker process activates layout for itself.
+            _activate_layout_if_requested(use_layout)
+            pool = _layout_convert_pool if use_layout else _convert_pool
+            page_chunks = await loop.run_in_executor(
+                pool, _convert_pdf, str(input_pdf), use_layout, markdown_kwargs
+            )
+            full_markdown = "\n\n".join(str(chunk.get("text", "")) for chunk in page_chunks)
+            if cacheable:
+                await asyncio.to_thread(
+                    _cache_put,
+                    cache_key,
+                    {"full_markdown": full_markdown, "page_chunks": page_chunks},
+                )
+        build_pages = response_format == "json"
+
+        # One pass per page: render, write artifacts and build the response
+        # entry while the page's strings are hot, instead of walking the
+        # chunk list once per concern.
+        async def _emit_page(idx: int, chunk: dict[str, Any]) -> dict[str, Any] | None:
+            page_text = str(chunk.get("text", ""))
+            page_html = (
+                await loop.run_in_executor(_html_pool, _markdown_to_html, page_text)
+                if include_html
+                else None
+            )
 
-        page_chunks = _normalize_page_chunks(chunks_raw)
+            def _write() -> None:
+                _write_bytes(pages_dir / f"page-{idx:04d}.md", page_text.encode("utf-8"))
+                if page_html is not None:
+                    _write_bytes(
+                        pages_html_dir / f"page-{idx:04d}.html", page_html.encode("utf-8")
+                    )
+
+            await asyncio.to_thread(_write)
+            if not build_pages:
+                return None
+            return {
+                "page_number": idx,
+                "markdown": page_text,
+                "html": page_html,
+                "metadata": chunk.get("metadata", {}),
+            }
+
+        full_html: str | None = (
+            await loop.run_in_executor(_html_pool, _markdown_to_html, full_markdown)
+            if include_html
+            else None
+        )
+        pages = await asyncio.gather(
+            *(_emit_page(idx, chunk) for idx, chunk in enumerate(page_chunks, start=1))
+        )
 
-        full_html = _markdown_to_html(full_markdown)
+        def _write_full() -> None:
+            _write_bytes(artifacts_dir / "full.md", full_markdown.encode("utf-8"))
+            if full_html is not None:
+                _write_bytes(artifacts_dir / "full.html", full_html.encode("utf-8"))
 
-        (artifacts_dir / "full.md").write_text(full_markdown, encoding="utf-8")
-        (artifacts_dir / "full.html").write_text(full_html, encoding="utf-8")
+        await asyncio.to_thread(_write_full)
 
-        for idx, chunk in enumerate(page_chunks, start=1):
-            page_text = str(chunk.get("text", ""))
-            (pages_dir / f"page-{idx:04d}.md").write_text(page_text, encoding="utf-8")
-            (pages_html_dir / f"page-{idx:04d}.html").write_text(
-                _markdown_to_html(page_text),
-                encoding="utf-8",
+        # One getdents pass; DirEntry caches the stat, unlike glob + is_file.
+        with os.scandir(images_dir) as entries:
+            image_names = sorted(
+                entry.name for entry in entries if entry.is_file(follow_symlinks=False)
             )
 
         manifest = {
@@ -248,26 +499,48 @@ async def process_pdf(
             "embed_images": embed_images,
             "layout_active": layout_active,
             "page_count": len(page_chunks),
-            "images": sorted([p.name for p in images_dir.glob("*") if p.is_file()]),
+            "images": image_names,
             "files": {
                 "full_markdown": "full.md",
-                "full_html": "full.html",
+                **({"full_html": "full.html", "pages_html_dir": "pages_html/"} if include_html else {}),
                 "pages_dir": "pages/",
-                "pages_html_dir": "pages_html/",
                 "images_dir": "images/",
             },
         }
-        (artifacts_dir / "manifest.json").write_text(
-            json.dumps(manifest, ensure_ascii=False, indent=2),
-            encoding="utf-8",
+        await asyncio.to_thread(
+            _write_bytes,
+            artifacts_dir / "manifest.json",
+            orjson.dumps(manifest, option=orjson.OPT_INDENT_2),
         )
 
         if response_format == "zip":
-            zip_path = workspace / "result"
-            archive_path = shutil.make_archive(str(zip_path), "zip", root_dir=artifacts_dir)
-            archive = Path(archive_path)
+            zip_file = workspace / "result.zip"
+
+            def _build_zip() -> None:
+                # Write through a raw fd so zipfile bypasses the buffered
+                # open() layer; FileResponse then streams the file with
+                # sendfile, never copying the archive through Python or RAM.
+                fd = os.open(zip_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with zipfile.ZipFile(os.fdopen(fd, "wb"), "w", zipfile.ZIP_DEFLATED) as archive:
+                    for path in sorted(artifacts_dir.rglob("*")):
+                        if not path.is_file():
+                            continue
+                        # PNG/JPEG payloads are already compressed; deflating
+                        # them again burns CPU for no size win.
+                        compress_type = (
+                            zipfile.ZIP_STORED
+                            if path.suffix.lower() in _PRECOMPRESSED_SUFFIXES
+                            else zipfile.ZIP_DEFLATED
+                        )
+                        archive.write(
+                            path,
+                            path.relative_to(artifacts_dir).as_posix(),
+                            compress_type=compress_type,
+                        )
+
+            await asyncio.to_thread(_build_zip)
             return FileResponse(
-                path=archive,
+                path=zip_file,
                 media_type="application/zip",
                 filename=f"{Path(file.filename).stem}-artifacts.zip",
                 background=BackgroundTask(_cleanup_path, workspace),
@@ -278,26 +551,18 @@ async def process_pdf(
             "full_markdown": full_markdown,
             "full_html": full_html,
             "layout_active": layout_active,
-            "pages": [
-                {
-                    "page_number": i,
-                    "markdown": str(chunk.get("text", "")),
-                    "html": _markdown_to_html(str(chunk.get("text", ""))),
-                    "metadata": chunk.get("metadata", {}),
-                }
-                for i, chunk in enumerate(page_chunks, start=1)
-            ],
+            "pages": pages,
             "embedded_images": embed_images,
         }
 
-        _cleanup_path(workspace)
-        return JSONResponse(response)
+        await asyncio.to_thread(_cleanup_path, workspace)
+        return ORJSONResponse(response)
 
     except HTTPException:
-        _cleanup_path(workspace)
+        await asyncio.to_thread(_cleanup_path, workspace)
         raise
     except Exception as exc:
-        _cleanup_path(workspace)
+        await asyncio.to_thread(_cleanup_path, workspace)
         raise HTTPException(status_code=500, detail=f"Processing failed: {exc}") from exc
 
 
@@ -1,17 +1,116 @@
 from collections.abc import Generator, Mapping
 import base64
 import binascii
+import hashlib
+import json
+import os
+import shutil
 import tempfile
+import threading
+import uuid
 from pathlib import Path
 from typing import Any
 from urllib.request import urlopen
 
+import cachetools
 import markdown as mdlib
 import pymupdf
 import pymupdf4llm
+import zstandard
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
+try:
+    from markdown_it_pyrs import MarkdownIt
+
+    # Built once at import; "gfm" covers tables, strikethrough and
+    # autolinks natively, fenced code is part of CommonMark. ValueError is
+    # caught too so an unknown config degrades to the fallback renderer
+    # instead of killing startup.
+    _md_renderer: MarkdownIt | None = MarkdownIt("gfm")
+except (ImportError, ValueError):
+    _md_renderer = None
+
+_CACHE_DIR = Path(os.environ.get("PYMUPDF4LLM_CACHE_DIR", "/tmp/pymupdf4llm-cache"))
+_cache: cachetools.LRUCache = cachetools.LRUCache(maxsize=128)
+_cache_lock = threading.Lock()
+
+_MD_EXTENSIONS = ["extra", "tables", "fenced_code", "sane_lists", "toc"]
+_md_local = threading.local()
+
+
+def _fallback_markdown() -> mdlib.Markdown:
+    # One configured instance per thread: extension loading dominates
+    # small-page renders, and Markdown objects are not thread-safe.
+    md = getattr(_md_local, "md", None)
+    if md is None:
+        md = mdlib.Markdown(extensions=_MD_EXTENSIONS, output_format="html")
+        _md_local.md = md
+    return md
+
+
+def _cache_key(pdf_bytes: bytes, kwargs: dict[str, Any]) -> str:
+    digest = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+    return digest + "|" + json.dumps(kwargs, sort_keys=True, default=str)
+
+
+def _cache_file(key: str) -> Path:
+    name = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+    return _CACHE_DIR / f"{name}.json.zst"
+
+
+def _cache_get(key: str) -> dict[str, Any] | None:
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        payload = json.loads(zstandard.decompress(_cache_file(key).read_bytes()))
+    except (OSError, ValueError, zstandard.ZstdError):
+        return None
+    with _cache_lock:
+        _cache[key] = payload
+    return payload
+
+
+def _cache_put(key: str, payload: dict[str, Any]) -> None:
+    with _cache_lock:
+        _cache[key] = payload
+    cache_file = _cache_file(key)
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_file.write_bytes(
+            zstandard.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        )
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # The disk tier is best-effort; the in-memory entry is already set.
+        pass
+
+
+def _iter_image_blobs(
+    images_dir: Path, image_names: list[str], image_format: str
+) -> Generator[tuple[str, str, bytes]]:
+    # Read lazily, one file per yield, so at most a single image's bytes
+    # are held Python-side no matter how many were extracted.
+    for image_name in image_names:
+        image_path = images_dir / image_name
+        suffix = image_path.suffix.lower().lstrip(".")
+        mime_type = f"image/{suffix if suffix else image_format}"
+        yield image_name, mime_type, image_path.read_bytes()
+
+
+def _download_pdf(url: str) -> bytes:
+    # Stream the body in 1 MiB chunks into a spooled temp file: small
+    # downloads stay in memory, large ones spill to disk instead of being
+    # buffered twice (socket + one huge bytes object) by resp.read().
+    with urlopen(url, timeout=60) as resp:  # nosec B310
+        with tempfile.SpooledTemporaryFile(max_size=64 << 20) as buf:
+            shutil.copyfileobj(resp, buf, length=1 << 20)
+            buf.seek(0)
+            return buf.read()
+
 
 class Pymupdf4llmTool(Tool):
     @staticmethod
@@ -28,10 +127,11 @@ class Pymupdf4llmTool(Tool):
 
     @staticmethod
     def _md_to_html(text: str) -> str:
-        return mdlib.markdown(
-            text,
-            extensions=["extra", "tables", "fenced_code", "sane_lists", "toc"],
-        )
+        if _md_renderer is not None:
+            return _md_renderer.render(text)
+        md = _fallback_markdown()
+        md.reset()
+        return md.convert(text)
 
     @staticmethod
     def _as_dict(value: Any) -> dict[str, Any] | None:
@@ -84,7 +184,9 @@ class Pymupdf4llmTool(Tool):
             for b64_key in ("base64", "content", "data"):
                 candidate = as_dict.get(b64_key)
                 if isinstance(candidate, str):
-                    raw = candidate.split(",", 1)[-1] if "," in candidate else candidate
+                    # partition scans once; "in" + split walked the payload twice.
+                    _, sep, tail = candidate.partition(",")
+                    raw = tail if sep else candidate
                     try:
                         return base64.b64decode(raw, validate=False)
                     except binascii.Error:
@@ -93,8 +195,7 @@ class Pymupdf4llmTool(Tool):
             for url_key in ("url", "download_url", "remote_url", "preview_url"):
                 candidate = as_dict.get(url_key)
                 if isinstance(candidate, str) and candidate.startswith(("http://", "https://")):
-                    with urlopen(candidate, timeout=60) as resp:  # nosec B310
-                        return resp.read()
+                    return _download_pdf(candidate)
 
         return None
 
@@ -116,13 +217,13 @@ class Pymupdf4llmTool(Tool):
         # Alternative: remote URL.
         pdf_url = tool_parameters.get("pdf_url")
         if isinstance(pdf_url, str) and pdf_url.startswith(("http://", "https://")):
-            with urlopen(pdf_url, timeout=60) as resp:  # nosec B310
-                return resp.read()
+            return _download_pdf(pdf_url)
 
         # Alternative: base64 payload.
         pdf_base64 = tool_parameters.get("pdf_base64")
         if isinstance(pdf_base64, str) and pdf_base64.strip():
-            raw = pdf_base64.split(",", 1)[-1] if "," in pdf_base64 else pdf_base64
+            _, sep, tail = pdf_base64.partition(",")
+            raw = tail if sep else pdf_base64
             try:
                 return base64.b64decode(raw, validate=False)
             except binascii.Error as exc:
@@ -141,45 +242,78 @@ class Pymupdf4llmTool(Tool):
             max_images = int(tool_parameters.get("max_images", 30) or 30)
             if max_images < 1:
                 max_images = 1
+            force_refresh = self._to_bool(tool_parameters.get("force_refresh", False), False)
+            output_html = self._to_bool(tool_parameters.get("output_html", False), False)
 
-            with tempfile.TemporaryDirectory(prefix="dify-pymupdf4llm-") as tmp:
-                pdf_path = Path(tmp) / "input.pdf"
-                images_dir = Path(tmp) / "images"
-                pdf_path.write_bytes(pdf_bytes)
-                images_dir.mkdir(parents=True, exist_ok=True)
-
-                full_markdown = pymupdf4llm.to_markdown(
-                    str(pdf_path),
-                    dpi=dpi,
-                    write_images=extract_images,
-                    image_path=str(images_dir),
-                    image_format=image_format,
-                )
-                chunks = pymupdf4llm.to_markdown(str(pdf_path), page_chunks=True, dpi=dpi)
-
-                pages_markdown = [str(c.get("text", "")) for c in chunks if isinstance(c, dict)]
-                pages_html = [self._md_to_html(md) for md in pages_markdown]
-                full_html = self._md_to_html(full_markdown)
-
-                # Plain text via PyMuPDF page extraction.
-                with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
-                    pages_text = [page.get_text("text") for page in doc]
-                full_text = "\n".join(pages_text)
-
-                image_files = sorted([p for p in images_dir.glob("*") if p.is_file()])
-                emitted_images: list[str] = []
-                if extract_images:
-                    for image_path in image_files[:max_images]:
-                        emitted_images.append(image_path.name)
-                        suffix = image_path.suffix.lower().lstrip(".")
-                        mime_type = f"image/{suffix if suffix else image_format}"
-                        yield self.create_blob_message(
-                            blob=image_path.read_bytes(),
-                            meta={
-                                "filename": image_path.name,
-                                "mime_type": mime_type,
-                            },
+            # Extracted image files are a side effect of the parse, so runs
+            # that emit them cannot be served from cache.
+            cacheable = not extract_images
+            cache_key = _cache_key(pdf_bytes, {"dpi": dpi, "image_format": image_format})
+            cached = None if (force_refresh or not cacheable) else _cache_get(cache_key)
+
+            emitted_images: list[str] = []
+            if cached is not None:
+                pages_markdown = [str(md) for md in cached.get("pages_markdown", [])]
+                full_markdown = "\n\n".join(pages_markdown)
+                pages_text = [str(text) for text in cached.get("pages_text", [])]
+            else:
+                with tempfile.TemporaryDirectory(prefix="dify-pymupdf4llm-") as tmp:
+                    images_dir = Path(tmp) / "images"
+                    images_dir.mkdir(parents=True, exist_ok=True)
+
+                    # Open straight from the in-memory bytes; no input.pdf
+                    # round trip through the temp directory. Stream-opened
+                    # documents have doc.name = None, so pass an explicit
+                    # filename or image writing crashes deriving image names.
+                    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+                        chunks = pymupdf4llm.to_markdown(
+                            doc,
+                            page_chunks=True,
+                            dpi=dpi,
+                            write_images=extract_images,
+                            image_path=str(images_dir),
+                            image_format=image_format,
+                            filename="input.pdf",
                         )
+                        # Plain text via PyMuPDF page extraction on the same
+                        # document; no second parse of the PDF.
+                        pages_text = [page.get_text("text") for page in doc]
+
+                    pages_markdown = [
+                        str(c.get("text", "")) for c in chunks if isinstance(c, dict)
+                    ]
+                    full_markdown = "\n\n".join(pages_markdown)
+
+                    with os.scandir(images_dir) as entries:
+                        image_names = sorted(
+                            e.name for e in entries if e.is_file(follow_symlinks=False)
+                        )
+                    if extract_images:
+                        for image_name, mime_type, blob in _iter_image_blobs(
+                            images_dir, image_names[:max_images], image_format
+                        ):
+                            emitted_images.append(image_name)
+                            yield self.create_blob_message(
+                                blob=blob,
+                                meta={
+                                    "filename": image_name,
+                                    "mime_type": mime_type,
+                                },
+                            )
+                            # Drop our reference before the next file is read.
+                            del blob
+
+                if cacheable:
+                    _cache_put(
+                        cache_key,
+                        {"pages_markdown": pages_markdown, "pages_text": pages_text},
+                    )
+
+            # HTML rendering is the costliest step after the parse; only run
+            # it when the caller asked for it.
+            pages_html = [self._md_to_html(md) for md in pages_markdown] if output_html else []
+            full_html = self._md_to_html(full_markdown) if output_html else ""
+            full_text = "\n".join(pages_text)
 
             result = {
                 "input": {
@@ -212,3 +346,7 @@ class Pymupdf4llmTool(Tool):
             yield self.create_json_message(result)
         except Exception as exc:
             yield self.create_json_message({"error": str(exc)})
+        finally:
+            # Release MuPDF's unbounded store between invocations so the
+            # long-running plugin process does not creep upward in RSS.
+            pymupdf.TOOLS.store_shrink(100)